@@ -1,38 +1,57 @@
-    import os
-    import pandas as pd
-    import csv
-    import numpy as np
-    import matplotlib.pyplot as plt
-    from datetime import datetime
+import os
+import threading
+import pandas as pd
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
+
+def find_header_row(file_path):
+    # Index of the header line for data, after the metadata lines
+    with open(file_path, mode='rb') as file:
+        for idx, line in enumerate(file):
+            if line.lstrip(b'"').startswith(b'Time'):
+                return idx
+    return None
+
+# Bump when read_dso_csv or read_pressure_csv change what they return, so older caches are ignored
+CACHE_VERSION = 1
+
+def cache_path_for(file_path):
+    return f'{file_path}.v{CACHE_VERSION}.parquet'
+
+def read_cached(file_path):
+    # Parsed copy of a csv saved next to it, used while it is newer than the csv
+    cache_path = cache_path_for(file_path)
+    try:
+        if os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+            return pd.read_parquet(cache_path)
+    except Exception:
+        pass
+    return None
+
+def write_cached(df, file_path):
+    try:
+        df.to_parquet(cache_path_for(file_path), compression='zstd')
+    except Exception as e:
+        print(f"Could not cache {file_path}: {e}")
 
 def read_dso_csv(file_path):
     try:
-        with open(file_path, mode='r') as file:
-            csv_reader = csv.reader(file)
-            
-            # Skip the metadata lines until we reach the header for data
-            for row in csv_reader:
-                if row and row[0].startswith('Time'):
-                    headers = row
-                    break
-            
-            # Read the data rows
-            data = []
-            for row in csv_reader:
-                if row:
-                    data.append(row)
-                    
-        # Create DataFrame
-        df = pd.DataFrame(data, columns=headers)
+        df = read_cached(file_path)
+        if df is not None:
+            return df
         
-        # Convert columns to appropriate data types
-        df['Time (ms)'] = pd.to_numeric(df['Time (ms)'])
+        header_row = find_header_row(file_path)
+        if header_row is None:
+            raise ValueError("no 'Time' header row found")
         
-        # Convert all "CH" columns to numeric
-        for col in df.columns:
-            if col.startswith('CH'):
-                df[col] = pd.to_numeric(df[col])
+        # Only the time and channel columns are parsed, straight to float by the C parser
+        df = pd.read_csv(file_path, skiprows=header_row, engine='c', dtype=np.float64, memory_map=True,
+                         usecols=lambda col: col == 'Time (ms)' or col.startswith('CH'))
         
+        write_cached(df, file_path)
         return df
     
     except FileNotFoundError:
@@ -44,6 +63,10 @@ def read_dso_csv(file_path):
 
 def read_pressure_csv(file_path):
     try:
+        pressure_data = read_cached(file_path)
+        if pressure_data is not None:
+            return pressure_data
+        
         # Read the CSV file, handling extra columns and empty rows
         pressure_data = pd.read_csv(file_path, usecols=[0, 1], skip_blank_lines=True)
         
@@ -51,13 +74,17 @@ def read_pressure_csv(file_path):
         pressure_data.columns = ['Date/Time', 'Pressure (micron)']
         
         # Convert 'Date/Time' to datetime format
-        pressure_data['Date/Time'] = pd.to_datetime(pressure_data['Date/Time'], format='%m/%d/%y %I:%M:%S %p', errors='coerce')
+        pressure_data['Date/Time'] = pd.to_datetime(pressure_data['Date/Time'], format='%m/%d/%y %I:%M:%S %p', errors='coerce', cache=True)
         pressure_data = pressure_data.dropna(subset=['Date/Time'])
         
-        # Convert all dates to 24-hour format
-        pressure_data['Date/Time'] = pressure_data['Date/Time'].dt.strftime('%Y-%m-%d %H:%M:%S')
-        pressure_data['Date/Time'] = pd.to_datetime(pressure_data['Date/Time'])
+        # Text rows such as a 'Max,---,' footer become NaN instead of turning the column into strings
+        pressure_data['Pressure (micron)'] = pd.to_numeric(pressure_data['Pressure (micron)'], errors='coerce').astype(np.float64)
         
+        # Index by time, merge_asof in map_pressure_to_files needs it sorted
+        pressure_data = pressure_data.set_index('Date/Time').sort_index(kind='stable')
+        pressure_data = pressure_data[~pressure_data.index.duplicated()]
+        
+        write_cached(pressure_data, file_path)
         return pressure_data
     
     except FileNotFoundError:
@@ -67,90 +94,160 @@ def read_pressure_csv(file_path):
         print(f"Error reading {file_path}: {e}")
         return None
 
-def find_maxes(df, channel):
-    maxes = []
-    prev = 0
-    av = np.mean(df[channel])
-    for k in df[channel]:
-        i = abs(k)
-        if prev > max(4 * i, av):
-            maxes.append(prev)
-            prev = i
-        elif prev < i:
-            prev = i
-    if maxes:
-        maxes.pop(0)
+@njit(cache=True, nogil=True)
+def _find_maxes(x, maxes):
+    # Writes the maxes of x into the front of maxes and returns how many were found
+    if x.shape[0] == 0:
+        return 0
+    
+    # Mean of the trace, taken in the same kernel so no NumPy pass is needed beforehand
+    total = 0.0
+    for k in range(x.shape[0]):
+        total += x[k]
+    
+    # Thresholds are fixed for the whole scan, so build them once in the sample dtype.
+    # Otherwise every comparison on a float32 trace would be promoted to float64
+    av = x.dtype.type(total / x.shape[0])
+    four = x.dtype.type(4)
+    
+    n = 0
+    prev = x.dtype.type(0)
+    for k in range(x.shape[0]):
+        i = abs(x[k])
+        # Branch free: always store prev and only advance n when it is a max.
+        # n <= k here, so the store never runs past the end of maxes
+        reset = (prev > av) & (prev > four * i)
+        maxes[n] = prev
+        n += reset
+        prev = i if reset else max(prev, i)
+    return n
+
+@njit(cache=True, nogil=True)
+def _batch_find_maxes(Y):
+    maxes = np.empty(Y.shape, dtype=Y.dtype)
+    counts = np.empty(Y.shape[0], dtype=np.int64)
+    for c in range(Y.shape[0]):
+        counts[c] = _find_maxes(Y[c], maxes[c])
+    return maxes, counts
+
+def _filter_maxes(maxes):
+    maxes = maxes[1:].astype(np.float64)
     if(len(maxes) > 1):    
         std = np.std(maxes, ddof=1)
     else:
         std = 10
     Lbound = np.mean(maxes) - 2 * std
     Ubound = np.mean(maxes) + 2* std
-    maxes = [m for m in maxes if m >= Lbound]
-    maxes = [m for m in maxes if m <= Ubound]
     
-    return maxes
+    return maxes[(maxes >= Lbound) & (maxes <= Ubound)]
+
+def batch_find_maxes(Y):
+    # Y holds one channel per row, so each channel is contiguous in memory
+    maxes, counts = _batch_find_maxes(Y)
+    return [_filter_maxes(maxes[c, :counts[c]]) for c in range(Y.shape[0])]
+
+def sample_step(t):
+    # Returns the sample spacing if the trace is uniformly sampled, otherwise None
+    if len(t) < 2:
+        return None
+    dt = t[1] - t[0]
+    if dt > 0 and np.all(np.abs(np.diff(t) - dt) < 1e-6 * dt):
+        return dt
+    return None
 
-def calculate_median_slope(df, channel):
-    slopes = np.diff(df[channel]) / np.diff(df['Time (ms)'])
-    median_slope = np.median(slopes)
+def calculate_median_slope(t, y, step=None):
+    # y can be a single channel or one channel per row
+    if step is not None:
+        return np.median(np.diff(y), axis=-1) / step
+    slopes = np.diff(y) / np.diff(t)
+    median_slope = np.median(slopes, axis=-1)
     return median_slope
 
+# Figure reused for every channel plot, one per worker thread, created on first use
+_plot_state = threading.local()
+
+def _get_plot_axes():
+    if not hasattr(_plot_state, 'fig'):
+        # A bare Figure renders off-screen without going through pyplot or a GUI backend
+        _plot_state.fig = Figure(figsize=(10, 6))
+        _plot_state.ax = _plot_state.fig.subplots()
+    return _plot_state.fig, _plot_state.ax
+
 def plot_ch_vs_time(df, channel, file_name, folder_path):
-    plt.figure(figsize=(10, 6))
-    plt.plot(df['Time (ms)'], df[channel], label=channel)
-    plt.xlabel('Time (ms)')
-    plt.ylabel(channel)
-    plt.title(f'{channel} vs Time (ms) for {file_name}')
-    plt.legend()
-    plt.grid(True)
+    fig, ax = _get_plot_axes()
+    ax.cla()
+    ax.plot(df['Time (ms)'], df[channel])
+    ax.set_xlabel('Time (ms)')
+    ax.set_ylabel(channel)
+    ax.set_title(f'{channel} vs Time (ms) for {file_name}')
+    ax.grid(True)
     
     plot_file_name = os.path.splitext(file_name)[0] + f'_{channel}.png'
     plot_file_path = os.path.join(folder_path, plot_file_name)
-    plt.savefig(plot_file_path)
-    plt.close()
-
-def map_pressure_to_file(pressure_data, file_name):
-    # Extract timestamp from file name
-    file_time_str = file_name.replace("Pokit DSO Export ", "").replace(".csv", "").replace("-", " ")
-    file_time = datetime.strptime(file_time_str, '%Y %m %d %H %M %S')
-    
-    # Find the nearest timestamp in the pressure data
-    closest_time = pressure_data.iloc[(pressure_data['Date/Time'] - file_time).abs().argsort()[:1]]
-    if not closest_time.empty:
-        return closest_time['Pressure (micron)'].values[0]
-    else:
-        return None
+    fig.savefig(plot_file_path, dpi=80)
+
+def map_pressure_to_files(pressure_data, file_names, file_times):
+    # Match every file to its nearest pressure reading in a single pass
+    files_df = pd.DataFrame({'File Name': file_names, 'ts': file_times.astype('datetime64[ns]')}).sort_values('ts')
+    pressure_data = pressure_data.set_axis(pressure_data.index.astype('datetime64[ns]'))
+    merged = pd.merge_asof(files_df, pressure_data, left_on='ts', right_index=True, direction='nearest')
+    return merged.set_index('File Name')['Pressure (micron)']
+
+# Columns of the per-channel summary, results are built column by column
+RESULT_COLUMNS = ['File Name', 'Channel', 'Mean of Maxes', 'Standard Deviation of Maxes', 'Median Slope', 'Pressure (micron)']
 
-def process_folder(folder_path, pressure_data, max_multiplier, pressure_multiplier):
-    results = []
-    
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith('.csv') and "Pokit DSO Export" in file_name:
-            file_path = os.path.join(folder_path, file_name)
-            df = read_dso_csv(file_path)
-            if df is not None:
-                for col in df.columns:
-                    if col.startswith('CH'):
-                        plot_ch_vs_time(df, col, file_name, folder_path)
-                        maxes = find_maxes(df, col)
-                        maxes = [m * max_multiplier for m in maxes]
-                        if maxes:
-                            mean_max = np.mean(maxes)
-                            std_max = np.std(maxes, ddof=1)
-                            median_slope = calculate_median_slope(df, col)
-                            pressure = map_pressure_to_file(pressure_data, file_name)
-                            if pressure is not None:
-                                pressure = float(pressure) * pressure_multiplier
-                            results.append({
-                                'File Name': file_name,
-                                'Channel': col,
-                                'Mean of Maxes': mean_max,
-                                'Standard Deviation of Maxes': std_max,
-                                'Median Slope': median_slope,
-                                'Pressure (micron)': pressure
-                            })
+def _process_file(file_name, folder_path, pressure, max_multiplier, plot_enabled):
+    results = {column: [] for column in RESULT_COLUMNS}
     
+    file_path = os.path.join(folder_path, file_name)
+    df = read_dso_csv(file_path)
+    # A capture with a header but no samples has nothing to analyse
+    if df is not None and len(df):
+        channels = [col for col in df.columns if col.startswith('CH')]
+        # Ask for float64 explicitly so an odd column dtype can't reach the compiled kernels
+        t = df['Time (ms)'].to_numpy(dtype=np.float64)
+        Y = np.ascontiguousarray(df[channels].to_numpy(dtype=np.float64).T)
+        step = sample_step(t)
+        if plot_enabled:
+            for col in channels:
+                plot_ch_vs_time(df, col, file_name, folder_path)
+        
+        # Analyse every channel of the capture at once
+        all_maxes = batch_find_maxes(Y)
+        median_slopes = calculate_median_slope(t, Y, step)
+        for col, maxes, median_slope in zip(channels, all_maxes, median_slopes):
+            maxes = maxes * max_multiplier
+            if len(maxes):
+                results['File Name'].append(file_name)
+                results['Channel'].append(col)
+                results['Mean of Maxes'].append(np.mean(maxes))
+                results['Standard Deviation of Maxes'].append(np.std(maxes, ddof=1))
+                results['Median Slope'].append(median_slope)
+                results['Pressure (micron)'].append(pressure)
+    
+    return results
+
+def process_folder(folder_path, pressure_data, max_multiplier, pressure_multiplier, plot_enabled=False):
+    results = {column: [] for column in RESULT_COLUMNS}
+    file_names = [file_name for file_name in os.listdir(folder_path)
+                  if file_name.endswith('.csv') and "Pokit DSO Export" in file_name]
+    
+    # Extract the timestamps from the file names in one pass
+    file_times = pd.to_datetime(file_names, format='Pokit DSO Export %Y-%m-%d-%H-%M-%S.csv', cache=True)
+    pressures = map_pressure_to_files(pressure_data, file_names, file_times) * pressure_multiplier
+    pressures = pressures.astype(object).where(pressures.notna(), None)
+    
+    # Each file is independent, so parse, plot and analyse them in parallel.
+    # Threads share memory and the heavy work releases the GIL, so nothing is pickled to workers
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(_process_file, file_name, folder_path, pressures[file_name], max_multiplier, plot_enabled)
+                   for file_name in file_names]
+        for future in futures:
+            for column, values in future.result().items():
+                results[column].extend(values)
+    
+    # Only a handful of channel names repeat down every row
+    results['Channel'] = pd.Categorical(results['Channel'])
     return pd.DataFrame(results)
 
 def plot_max_vs_pressure(all_results):
@@ -168,7 +265,7 @@ def plot_max_vs_pressure(all_results):
     plt.grid(True)
     plt.show()
 
-def process_multiple_folders(folder_paths, pressure_file_paths, multipliers, output_path):
+def process_multiple_folders(folder_paths, pressure_file_paths, multipliers, output_path, plot_enabled=False):
     all_results = {}
     
     for folder_path, pressure_file_path, multiplier in zip(folder_paths, pressure_file_paths, multipliers):
@@ -178,40 +275,42 @@ def process_multiple_folders(folder_paths, pressure_file_paths, multipliers, out
             continue
         max_multiplier = multiplier['max_multiplier']
         pressure_multiplier = multiplier['pressure_multiplier']
-        results_df = process_folder(folder_path, pressure_data, max_multiplier, pressure_multiplier)
+        results_df = process_folder(folder_path, pressure_data, max_multiplier, pressure_multiplier, plot_enabled)
         if not results_df.empty:
             all_results[folder_path] = results_df
     
     plot_max_vs_pressure(all_results)
 
-    # Save the combined results
-    combined_results = pd.concat(all_results.values(), ignore_index=True)
-    combined_results.to_csv(output_path, index=False)
+    # Save the combined results, writing each folder's rows straight to the file
+    with open(output_path, mode='w', newline='', encoding='utf-8') as file:
+        for idx, results_df in enumerate(all_results.values()):
+            results_df.to_csv(file, header=(idx == 0), index=False)
 
 # Example usage
-folder_paths = [
-    r"C:\Users\ethan\Downloads\Paaschen1Magnets38.8cm99.8",
-    #r"C:\Users\ethan\Downloads\Paaschen1NoMag38.3cm99.8",
-    r"C:\Users\ethan\Downloads\Paaschen2Mag38.3cm99.8",
-    r"C:\Users\ethan\Downloads\Paaschen2NoMag38.3cm99.8",
-    r"C:\Users\ethan\Downloads\Paaschen3NoMag38.3cm99.8"
-
-    
-]
-pressure_file_paths = [
-    r"C:\Users\ethan\Downloads\2024-06-17-17-46-07.csv",
-    #r"C:\Users\ethan\Downloads\2024-06-18-11-41-41.csv",
-    r"C:\Users\ethan\Downloads\2024-06-18-17-06-11.csv",
-    r"C:\Users\ethan\Downloads\2024-06-24-12-07-26.csv",
-    r"C:\Users\ethan\Downloads\2024-06-24-16-54-11.csv"
-    
-]
-multipliers = [
-    #{'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8},
-    {'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8},
-    {'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8},
-    {'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8},
-    {'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8}
-]
-output_path = r"C:\Users\ethan\Downloads\combined_summary_resultslong.csv"
-process_multiple_folders(folder_paths, pressure_file_paths, multipliers, output_path)
+if __name__ == '__main__':
+    folder_paths = [
+        r"C:\Users\ethan\Downloads\Paaschen1Magnets38.8cm99.8",
+        #r"C:\Users\ethan\Downloads\Paaschen1NoMag38.3cm99.8",
+        r"C:\Users\ethan\Downloads\Paaschen2Mag38.3cm99.8",
+        r"C:\Users\ethan\Downloads\Paaschen2NoMag38.3cm99.8",
+        r"C:\Users\ethan\Downloads\Paaschen3NoMag38.3cm99.8"
+
+    
+    ]
+    pressure_file_paths = [
+        r"C:\Users\ethan\Downloads\2024-06-17-17-46-07.csv",
+        #r"C:\Users\ethan\Downloads\2024-06-18-11-41-41.csv",
+        r"C:\Users\ethan\Downloads\2024-06-18-17-06-11.csv",
+        r"C:\Users\ethan\Downloads\2024-06-24-12-07-26.csv",
+        r"C:\Users\ethan\Downloads\2024-06-24-16-54-11.csv"
+    
+    ]
+    multipliers = [
+        #{'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8},
+        {'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8},
+        {'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8},
+        {'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8},
+        {'max_multiplier': 10.48 / 0.105, 'pressure_multiplier': 38.8}
+    ]
+    output_path = r"C:\Users\ethan\Downloads\combined_summary_resultslong.csv"
+    process_multiple_folders(folder_paths, pressure_file_paths, multipliers, output_path)